@@ -1,15 +1,26 @@
+import io
 import os
 import pathlib
 import re
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pprint import pprint
+from textwrap import indent
 from typing import Iterable
 
 
-def apply(funcs, val):
-    for f in reversed(funcs):
-        val = f(val)
-    return val
+_RE_DIRECTIVE = re.compile(r"#\s*(\w*)")
+_RE_IFNDEF = re.compile(r"^#\s*ifndef\s+([A-Za-z0-9_]+)")
+# classifies a '#' line in a single pass, the matching alternative is reported as m.lastgroup
+_RE_LINE = re.compile(
+    r"^#\s*(?P<if>if\w*)"
+    r"|^#\s*(?P<endif>endif)"
+    r"|^#\s*(?P<inc>include\s*(?P<incarg>.*))"
+)
+
+# directives that are dropped by Namespacer.filter_preprocessor
+_SKIP_DIRECTIVES = frozenset({"elif", "elifdef", "elifndef", "else", "define", "undef", "error", "pragma", "warning"})
 
 
 class CannotProcess(Exception):
@@ -22,7 +33,13 @@ class Namespacer(object):
         self.file = pathlib.Path(file)
         self.lines = lines
         self.namespace = namespace
-        self.out_buf = []
+        self._ns_marker = "namespace " + namespace
+        self.open_namespace = "namespace %s {\n" % namespace
+        self.close_namespace = "} // end namespace %s\n" % namespace
+        self.would_open_namespace = "// namespace %s {\n" % namespace
+        self.would_close_namespace = "// } // end namespace %s\n" % namespace
+        self._excluded = frozenset((self.would_open_namespace, self.would_close_namespace))
+        self.out_buf = io.StringIO()
         self.msgs = []
 
         self.line_nr = -1
@@ -32,99 +49,104 @@ class Namespacer(object):
         self.nesting_depth = 0
         self.drop_lines = 0
         self.status = None
-
-    @property
-    def open_namespace(self):
-        return "namespace %s {\n" % self.namespace
-
-    @property
-    def close_namespace(self):
-        return "} // end namespace %s\n" % self.namespace
-
-    @property
-    def would_open_namespace(self):
-        return "// namespace %s {\n" % self.namespace
-
-    @property
-    def would_close_namespace(self):
-        return "// } // end namespace %s\n" % self.namespace
+        # set whenever lines are inserted into out_buf, i.e. the output differs from the input
+        self._modified = False
+        # set when the markers of a previous --comment run were stripped, which may be re-inserted at the same places
+        self._stripped_markers = False
 
     def iter_lines(self):
-        excluded = [self.would_open_namespace, self.would_close_namespace]
-        for self.line_nr, self.full_line in enumerate(self.lines, start=1):
-            if self.full_line in excluded:
+        excluded = self._excluded
+        for line_nr, full_line in enumerate(self.lines, start=1):
+            # the filters and process() read these for their messages
+            self.line_nr = line_nr
+            self.full_line = full_line
+            if full_line in excluded:
+                self._stripped_markers = True
                 continue  # strip the line from the out_buf
-            yield self.full_line
+            yield full_line
             if self.drop_lines > 0:
                 self.drop_lines -= 1
             else:
-                self.out_buf.append(self.full_line)
+                self.out_buf.write(full_line)
 
-    def filter_empty_or_comment(self, iter):
-        for l in iter:
+    def filter_empty_or_comment(self, it):
+        _next = it.__next__
+        in_comment_block = False
+        for l in it:
             l = l.strip()
             if not l or l.startswith("//"):
                 continue
-            while l.endswith("\\"):
-                l = l[:-1].strip() + next(iter).strip()
-            yield l
-
-    def filter_comment_block(self, iter):
-        for l in iter:
-            while l.startswith("/*"):
+            if l.endswith("\\"):
+                parts = [l[:-1].strip()]
+                l = _next().strip()
+                while l.endswith("\\"):
+                    parts.append(l[:-1].strip())
+                    l = _next().strip()
+                parts.append(l)
+                l = "".join(parts)
+
+            if not in_comment_block:
+                if not l.startswith("/*"):
+                    yield l
+                    continue
                 l = l[2:]
-                while True:
-                    try:
-                        yield l[l.index("*/") + 2:].strip()
-                        l = next(iter)
-                        break
-                    except ValueError:  # line contains no '*/'
-                        l = next(iter)
-                    except StopIteration:  # line contains '*/', but is last line
-                        return
-
-            yield l
+            try:
+                l = l[l.index("*/") + 2:].strip()
+            except ValueError:  # line contains no '*/'
+                in_comment_block = True
+                continue
+            in_comment_block = False
+            # only the remainder after the end of the block, which is not checked for further blocks
+            if l and not l.startswith("//"):
+                yield l
 
-    def filter_include_guard(self, iter):
-        for l in iter:
+    def filter_include_guard(self, it):
+        _next = it.__next__
+        for l in it:
             if not self.include_guard:
-                m = re.match("^#\s*ifndef\s+([A-Za-z0-9_]+)", l)
+                m = _RE_IFNDEF.match(l)
                 if m:  # and self.file.name.rsplit(".")[0].lower() in m.group(1).lower():
-                    l_d = next(iter)
-                    if not re.match("^#\s*define\s+" + m.group(1), l_d):
+                    l_d = _next()
+                    define = l_d[1:].split(None, 2) if l_d.startswith("#") else ()
+                    if len(define) < 2 or define[0] != "define" or define[1] != m.group(1):
                         self.msgs.append("broken include guard for '%s' in line %s:\n%s\n%s" % (m.group(1), self.line_nr - 1, l, l_d))
                         yield l
                         yield l_d
-                        yield from iter  # stop processing further include guards
+                        yield from it  # stop processing further include guards
                         return
                     else:
                         self.include_guard = True
 
-                    l = next(iter)
+                    l = _next()
 
             yield l
 
-    def filter_preprocessor(self, iter):
-        for l in iter:
-            if not re.match("^#\s*(elif|else|define|undef|error|pragma|warning)", l):
+    def filter_preprocessor(self, it):
+        for l in it:
+            if not l.startswith("#"):
+                yield l
+            elif _RE_DIRECTIVE.match(l).group(1) not in _SKIP_DIRECTIVES:
                 yield l
 
     # after filter_preprocessor: only '#if...', '#endif', '#include ...' and code lines
 
-    def consume_if(self, iter, old_line):
+    def consume_if(self, it, old_line):
+        _next = it.__next__
         old_line_nr = self.line_nr
         old_out_buf = self.out_buf
-        tmp_out_buf = self.out_buf = []
+        tmp_out_buf = self.out_buf = io.StringIO()
         include_line = code_line = None
 
         self.nesting_depth = 1
-        l = next(iter)
+        l = _next()
         while self.nesting_depth > 0:
-            if re.match("^#\s*endif", l):
+            # the directive is only needed up to its name, so plain prefix checks suffice
+            directive = l[1:].lstrip() if l.startswith("#") else ""
+            if directive.startswith("endif"):
                 self.nesting_depth -= 1
-            elif re.match("^#\s*if", l):
+            elif directive.startswith("if"):
                 self.nesting_depth += 1
-            elif re.match("^#\s*include", l):
+            elif directive.startswith("include"):
                 if not include_line:
                     include_line = (l, self.line_nr, self.nesting_depth)
             else:  # code lines
@@ -132,7 +154,7 @@ class Namespacer(object):
                     code_line = (l, self.line_nr, self.nesting_depth)
 
             try:
-                l = next(iter)
+                l = _next()
             except StopIteration:
                 # file ended with '#endif' (if nesting_depth == 0) or unclosed '#if'
                 l = None
@@ -145,31 +167,29 @@ class Namespacer(object):
         raise CannotProcess(msg)
 
     def process(self):
-        code_lines = apply(
-            [self.filter_preprocessor,
-             self.filter_include_guard,
-             self.filter_empty_or_comment,
-             self.filter_comment_block,
-             self.filter_empty_or_comment],
-            self.iter_lines()
-        )
+        code_lines = self.filter_preprocessor(self.filter_include_guard(self.filter_empty_or_comment(self.iter_lines())))
 
         includes = set()
+        # consume_if() restores self.out_buf before returning, so these stay valid throughout
+        write = self.out_buf.write
+        msgs_append = self.msgs.append
 
         for line in code_lines:
-            while line and re.match("^#\s*if", line):
+            m = _RE_LINE.match(line) if line.startswith("#") else None
+            tok = m.lastgroup if m else None
+            while tok == "if":
                 first_if_line = line
                 first_if_line_nr = self.line_nr
                 line, include_line, code_line, if_lines = self.consume_if(code_lines, line)
 
                 if include_line and code_line:
-                    self.msgs.append(
+                    msgs_append(
                         "'%s' starting on line %s contains '#includes' and code:\n%s: %s\n%s: %s"
                         % (first_if_line, first_if_line_nr, include_line[1], include_line[0],
                            code_line[1], code_line[0]))
                     self.error("mixed #if" + (" within namespace" if self.namespace_active else ""))
                 elif include_line and self.namespace_active:
-                    self.msgs.append(
+                    msgs_append(
                         "'%s' in line %s (contained within '%s' starting in line %s) "
                         "after first line of code in line %s: %s"
                         % (include_line[0], include_line[1], first_if_line, first_if_line_nr,
@@ -178,84 +198,142 @@ class Namespacer(object):
                     self.error("include within #if within namespace")
                     # we can't easily close the namespace, as e.g. a class might be open
                 elif code_line and not self.namespace_active:
-                    self.msgs.append(
+                    msgs_append(
                         "inserting namespace before '%s' on line %s because it contains code on line %s: %s"
                         % (first_if_line, first_if_line_nr, code_line[1], code_line[0]))
-                    self.out_buf.append(self.open_namespace)
+                    write(self.open_namespace)
+                    self._modified = True
                     self.namespace_active = (first_if_line, first_if_line_nr)
                 # else everything is alright
 
-                self.out_buf.extend(if_lines)
+                write(if_lines.getvalue())
+                m = _RE_LINE.match(line) if line and line.startswith("#") else None
+                tok = m.lastgroup if m else None
             if not line:
                 continue
 
-            if re.match("^#\s*endif", line):
+            if tok == "endif":
                 if self.include_guard:
                     self.include_guard = False
                     if self.namespace_active:
                         self.namespace_active = False
-                        self.msgs.append(
+                        msgs_append(
                             "closing namespace before closing include guard on line %s: %s" % (self.line_nr, line))
-                        self.out_buf.append(self.close_namespace)
+                        write(self.close_namespace)
+                        self._modified = True
                     # else there is nothing to close, i.e. no code within the include guards
                 else:
-                    self.msgs.append("superfluous '#endif' in line %s: %s" % (self.line_nr, line))
-            elif re.match("^#\s*include", line):
-                included = re.match("^#\s*include (.*)", line).group(1).strip()
+                    msgs_append("superfluous '#endif' in line %s: %s" % (self.line_nr, line))
+            elif tok == "inc":
+                included = m.group("incarg").strip()
                 if self.namespace_active:
                     if included in includes:
-                        self.msgs.append(
+                        msgs_append(
                             "'%s' in line %s was also included above, ignoring second #include now within namespace"
                             % (line, self.line_nr)
                         )
                         self.drop_lines += 1
-                        self.out_buf.append("// this include was already seen before, outside the namespace, so ignoring it here")
-                        self.out_buf.append("// " + line)
+                        write("// this include was already seen before, outside the namespace, so ignoring it here")
+                        write("// " + line)
+                        self._modified = True
                     else:
-                        self.msgs.append(
+                        msgs_append(
                             "'%s' in line %s after first line of code in line %s: %s"
                             % (line, self.line_nr, self.namespace_active[1], self.namespace_active[0])
                         )
                         if includes:
-                            self.msgs.append("seen includes: %s" % ", ".join(includes))
+                            msgs_append("seen includes: %s" % ", ".join(includes))
                         self.error("#include within namespace")
                 else:
                     # an include before we opened or after we closed the namespace is okay
                     includes.add(included)
             else:  # code line
-                if "namespace " + self.namespace in line:
-                    self.msgs.append("namespace already present in line %s: %s" % (self.line_nr, line))
+                if self._ns_marker in line:
+                    msgs_append("namespace already present in line %s: %s" % (self.line_nr, line))
                     return "namespace already present"
 
-                is_class_predec = re.match("^\s*class\s*([^\s]+)\s*;\s*$", line)
+                is_class_predec = None  # the name of the predeclared class
+                if line.startswith("class") and line.endswith(";"):
+                    decl = line[:-1].split()
+                    if len(decl) == 2 and decl[0] == "class":
+                        is_class_predec = decl[1]
                 if not self.namespace_active:
                     if is_class_predec:
                         self.drop_lines += 1
-                        self.out_buf.append(self.open_namespace)
-                        self.out_buf.append(line + "\n")
-                        self.out_buf.append(self.close_namespace)
-                        self.msgs.append("namespaced class '%s' predeclaration in line %s: %s" % (is_class_predec.group(1), self.line_nr, line))
+                        write(self.open_namespace)
+                        write(line + "\n")
+                        write(self.close_namespace)
+                        self._modified = True
+                        msgs_append("namespaced class '%s' predeclaration in line %s: %s" % (is_class_predec, self.line_nr, line))
                     else:
-                        self.msgs.append("inserting namespace before code line %s: %s" % (self.line_nr, line))
-                        self.out_buf.append(self.open_namespace)
+                        msgs_append("inserting namespace before code line %s: %s" % (self.line_nr, line))
+                        write(self.open_namespace)
+                        self._modified = True
                         self.namespace_active = (line, self.line_nr)
                 # else a code line within the namespace is perfectly fine
 
         if self.namespace_active:
-            self.msgs.append("closing namespace after last line %s: %s" % (self.line_nr, self.full_line.rstrip("\n")))
-            self.out_buf.append(self.close_namespace)
+            msgs_append("closing namespace after last line %s: %s" % (self.line_nr, self.full_line.rstrip("\n")))
+            write(self.close_namespace)
+            self._modified = True
 
         if self.status:
             return self.status
-        elif self.out_buf == self.lines:
+        elif not self._modified and not self._stripped_markers:
             return "empty"
         else:
             return "success"
 
 
+class _CommentNamespacer(Namespacer):
+    def __init__(self, file, lines: Iterable[str], namespace: str):
+        super().__init__(file, lines, namespace)
+        self.open_namespace = self.would_open_namespace
+        self.close_namespace = self.would_close_namespace
+
+
+class _ErrorsNamespacer(Namespacer):
+    def error(self, msg):
+        if not self.status:
+            self.status = msg
+        self.msgs.append(msg)
+        msg = msg.strip() + "\n"
+        self.out_buf.write(indent(msg, "// "))
+        self._modified = True
+
+
+class _ErrorsCommentNamespacer(_ErrorsNamespacer, _CommentNamespacer):
+    pass
+
+
+def _process_one(file, cls, namespace, force, dry_run):
+    # read and decode the whole file at once, StringIO then yields its lines without further decoding
+    text = file.read_text()
+    ns = cls(file, io.StringIO(text), namespace)
+    try:
+        result = ns.process()
+    except CannotProcess as e:
+        result = e.args[0]
+    new_text = ns.out_buf.getvalue()
+    if result == "success" and ns._stripped_markers and new_text == text:
+        # --comment inserted the stripped markers at the same places again
+        result = "empty"
+    write_back = not dry_run and (result == "success" or (result not in ("empty", "namespace already present") and force))
+    return file, result, ns.msgs, new_text if write_back else None
+
+
+def _process_files(process_one, files):
+    workers = min(len(files), os.cpu_count() or 1)
+    if workers <= 1:
+        # not worth starting worker processes for a single file or CPU
+        yield from map(process_one, files)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        yield from ex.map(process_one, files, chunksize=max(1, len(files) // (4 * workers)))
+
+
 def main():
     import argparse
-    from textwrap import indent
     parser = argparse.ArgumentParser(description='Automatically add namespaces around your .h and .cpp files.')
     parser.add_argument('files', type=pathlib.Path, nargs='+', help='the files to process in-place')
     parser.add_argument('--namespace', default='my_namespace', help='the name of the namespace to add')
@@ -266,35 +344,22 @@ def main():
     parser.add_argument('--comment', '-c', action='store_true', help='only mark namespace begin and end with comment')
     args = parser.parse_args()
 
+    cls = Namespacer
     if args.comment:
-        Namespacer.open_namespace = Namespacer.would_open_namespace
-        Namespacer.close_namespace = Namespacer.would_close_namespace
-
+        cls = _CommentNamespacer
     if args.errors:
-        def error(self, msg):
-            if not self.status:
-                self.status = msg
-            self.msgs.append(msg)
-            msg = msg.strip() + "\n"
-            self.out_buf.extend(indent(msg, "// ").splitlines(keepends=True))
-
-        Namespacer.error = error
+        cls = _ErrorsCommentNamespacer if args.comment else _ErrorsNamespacer
 
+    process_one = partial(_process_one, cls=cls, namespace=args.namespace, force=args.force, dry_run=args.dry_run)
     results = defaultdict(dict)
-    for file in sorted(args.files):
-        with open(file, "rt") as f:
-            ns = Namespacer(file, f.readlines(), args.namespace)
-        try:
-            result = ns.process()
-        except CannotProcess as e:
-            result = e.args[0]
-        results[result][file] = ns.msgs
-        if not args.dry_run and (result == "success" or (result != "namespace already present" and args.force)):
-            with open(file, "wt") as f:
-                f.writelines(ns.out_buf)
-
-    common = os.path.commonpath(args.files)
+    # files are independent, but the results are collected and written back in order by this process
+    for file, result, msgs, new_text in _process_files(process_one, sorted(args.files)):
+        results[result][file] = msgs
+        if new_text is not None:
+            file.write_text(new_text)
+
     if not args.quiet:
+        common = os.path.commonpath(args.files)
         for key, files in results.items():
             print("\n\n# " + key + "\n")
             for file, msgs in files.items():